@@ -0,0 +1,29 @@
+# Compiled grouping kernel. Kept out of the Streamlit script because Numba's disk
+# cache re-imports the defining module, and this one must have no side effects.
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; grouping falls back to pandas
+    njit = None
+
+def _assign_groups(keys, admit_ns, discharge_ns, threshold_ns):
+    # Single pass over records sorted by key then admit date
+    nat = np.iinfo(np.int64).min
+    group_ids = np.empty(len(keys), dtype=np.int64)
+    group = 0
+    latest_discharge = nat
+    for i in range(len(keys)):
+        if i == 0 or keys[i] != keys[i - 1]:
+            group += 1
+            latest_discharge = nat
+        # As in the pandas path, a record following one with no discharge date never splits
+        elif discharge_ns[i - 1] != nat and admit_ns[i] - latest_discharge >= threshold_ns:
+            group += 1
+        group_ids[i] = group
+        if discharge_ns[i] != nat and discharge_ns[i] > latest_discharge:
+            latest_discharge = discharge_ns[i]
+    return group_ids
+
+# None when numba is unavailable
+assign_groups = njit(cache=True)(_assign_groups) if njit is not None else None
@@ -1,9 +1,17 @@
+import hashlib
+import os
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import timedelta
 from io import BytesIO
+from pathlib import Path
+import matplotlib
+matplotlib.use("Agg")  # Headless backend; figures are only ever rendered to PNG
 import matplotlib.pyplot as plt
 
+from grouping import assign_groups
+
 st.title("🏥 Patient Admission Grouper & LA Patient Stats")
 
 uploaded_file = st.file_uploader("Upload a CSV or XLSX file", type=["csv", "xlsx"])
@@ -16,104 +24,285 @@ def fill_missing_discharge_dates(df):
     df.loc[mask_i, "Discharge Date"] = pd.to_datetime("2050-01-01")
     return df
 
-@st.cache_data
-def load_data(file):
+# Date format used by the source system's exports
+DATE_FORMAT = "%m/%d/%Y"
+
+# Parsed uploads are only cached on disk, as Feather files named by content hash,
+# when this is set; the files hold full patient records and are never deleted by the app
+CACHE_DIR = os.environ.get("INPATIENT_FINDER_CACHE_DIR")
+
+# Bump whenever parse_upload's output changes so older cache files are not reused
+PARSE_VERSION = 1
+
+# Rows of the filtered patient table rendered in the page; the download has them all
+PREVIEW_ROWS = 200
+
+# Columns shown in and downloaded from the filtered patient table
+OUTPUT_COLUMNS = [
+    "Medical Record #",
+    "First Name",
+    "Last Name",
+    "Med Service",
+    "Patient Address",
+    "Patient Address (ln2)",
+    "Patient City",
+    "Patient State",
+    "Patient Email Address"
+]
+
+# Only these columns are read from uploads; everything else is never used
+REQUIRED_COLUMNS = OUTPUT_COLUMNS + ["Admit Date", "Discharge Date", "Patient Type", "Patient Class"]
+
+def parse_dates(values):
+    # Parse with the known format first and only infer formats for values it misses
+    parsed = pd.to_datetime(values, format=DATE_FORMAT, errors="coerce", cache=True)
+    unparsed = parsed.isna() & values.notna()
+    if unparsed.any():
+        parsed[unparsed] = pd.to_datetime(values[unparsed], errors="coerce", cache=True)
+    return parsed
+
+def parse_upload(file):
     if file.name.endswith(".xlsx"):
-        df = pd.read_excel(file, sheet_name=0, parse_dates=["Admit Date", "Discharge Date"])
+        df = pd.read_excel(
+            file,
+            sheet_name=0,
+            engine="calamine",
+            usecols=REQUIRED_COLUMNS,
+            parse_dates=["Admit Date", "Discharge Date"]
+        )
     else:
-        df = pd.read_csv(file, parse_dates=["Admit Date", "Discharge Date"])
+        try:
+            df = pd.read_csv(file, engine="pyarrow", usecols=REQUIRED_COLUMNS)
+        except (ImportError, ValueError):
+            # Fall back to the C parser if pyarrow is missing or rejects the file
+            file.seek(0)
+            df = pd.read_csv(
+                file,
+                engine="c",
+                usecols=REQUIRED_COLUMNS,
+                parse_dates=["Admit Date", "Discharge Date"],
+                date_format=DATE_FORMAT,
+                cache_dates=True,
+                low_memory=False
+            )
+        # pyarrow leaves these as strings, as does the C parser when the format doesn't match
+        for col in ["Admit Date", "Discharge Date"]:
+            if not pd.api.types.is_datetime64_any_dtype(df[col]):
+                df[col] = parse_dates(df[col])
     df = df.dropna(subset=["Admit Date"])
+
+    # Low-cardinality columns used as filter and group keys are stored as categoricals
+    for col in ["Medical Record #", "Patient State", "Patient Type", "Patient Class"]:
+        df[col] = df[col].astype("category")
+
     df = fill_missing_discharge_dates(df)
+    return df.reset_index(drop=True)
+
+def private_cache_dir():
+    # The cache is opt-in and only used if the directory is private to this user
+    if not CACHE_DIR:
+        return None
+    cache_dir = Path(CACHE_DIR)
+    try:
+        cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        info = cache_dir.stat()
+    except OSError:
+        return None
+    if info.st_mode & 0o077 or (hasattr(os, "getuid") and info.st_uid != os.getuid()):
+        return None
+    return cache_dir
+
+@st.cache_data
+def load_data(file):
+    cache_dir = private_cache_dir()
+    if cache_dir is None:
+        return parse_upload(file)
+
+    # Re-uploads of the same file are read back from a Feather copy of the parsed frame
+    # The key covers the parse settings as well as the bytes, so changing them invalidates it
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(repr((PARSE_VERSION, DATE_FORMAT, REQUIRED_COLUMNS)).encode("utf-8"))
+    hasher.update(file.getvalue())
+    cache_path = cache_dir / f"{hasher.hexdigest()}.feather"
+    if cache_path.exists():
+        try:
+            return pd.read_feather(cache_path)
+        except (OSError, TypeError, ValueError):
+            # Unreadable or incompatible cache file; drop it and parse the upload again
+            cache_path.unlink(missing_ok=True)
+
+    df = parse_upload(file)
+    tmp_path = cache_path.with_suffix(".tmp")
+    try:
+        # Create the file owner-only before any patient data is written to it
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as tmp_file:
+            df.to_feather(tmp_file)
+        tmp_path.replace(cache_path)
+    except (OSError, TypeError, ValueError):
+        # A failed cache write only costs a re-parse next time
+        tmp_path.unlink(missing_ok=True)
     return df
 
-def correct_patient_state(state):
-    if str(state).strip() != "CA":
-        return state
-    known_invalids_for_CA = {
-        "Zug": "International",
-        "Sao Paulo": "International",
-        "Paris": "International",
-        "Dededo": "GU",
-        "Agat": "GU",
-        "Yigo": "GU",
-        "Hagatna": "GU",
-        "Lio Lio": "AS",
-        "Saipan": "MP"
-    }
-    return known_invalids_for_CA.get(str(state).strip(), "CA")
-
-def group_patient_records(patient_df, days_threshold):
-    patient_df = patient_df.sort_values("Admit Date").reset_index(drop=True)
-    group = 1
-    group_ids = [group]  # First record always starts a group
-
-    for i in range(1, len(patient_df)):
-        prev_discharge = patient_df.loc[i - 1, "Discharge Date"]
-        curr_admit = patient_df.loc[i, "Admit Date"]
-        day_gap = (curr_admit - prev_discharge).days
-
-        if day_gap >= days_threshold:
-            group += 1  # Start a new group
-        group_ids.append(group)
-
-    patient_df["Group"] = group_ids
-    return patient_df
+KNOWN_INVALIDS_FOR_CA = {
+    "Zug": "International",
+    "Sao Paulo": "International",
+    "Paris": "International",
+    "Dededo": "GU",
+    "Agat": "GU",
+    "Yigo": "GU",
+    "Hagatna": "GU",
+    "Lio Lio": "AS",
+    "Saipan": "MP"
+}
+# Built once so each correction is a single vectorized Series.map lookup
+_state_override = pd.Series(KNOWN_INVALIDS_FOR_CA)
 
-def convert_df_to_csv(df):
-    buffer = BytesIO()
-    df.to_csv(buffer, index=False)
-    buffer.seek(0)
-    return buffer
+def correct_patient_state(df):
+    # Records marked CA whose city is known to be outside California get the real state
+    is_ca = df["Patient State"].astype(str).str.strip() == "CA"
+    city_override = df["Patient City"].astype(str).str.strip().map(_state_override)
+    corrected = np.where(is_ca, city_override.fillna("CA"), df["Patient State"])
+    return pd.Series(corrected, index=df.index, dtype="category")
 
-if uploaded_file:
-    df = load_data(uploaded_file)
+def group_patient_records(df, days_threshold, key):
+    # Sort once so records sharing a grouping key are contiguous and in admit order
+    order = np.lexsort((df["Admit Date"].values, key))
+    df = df.iloc[order].reset_index(drop=True)
+    key = key[order]
 
-    # Remove threshold UI and use fixed 20 days
-    days_threshold = 20
+    if assign_groups is not None:
+        # Date columns may be in s/us/ms resolution, so cast to ns to match the threshold
+        threshold_ns = np.int64(pd.Timedelta(days=days_threshold).value)
+        df["Group"] = assign_groups(
+            key,
+            df["Admit Date"].values.astype("datetime64[ns]").view("i8"),
+            df["Discharge Date"].values.astype("datetime64[ns]").view("i8"),
+            threshold_ns
+        )
+        return df
 
-    # Filter out telemedicine patients
-    df = df[df["Patient Type"] != "Telemedicine"]
+    key = pd.Series(key)
 
-    # Correct patient states
-    df["Patient State"] = df["Patient State"].apply(correct_patient_state)
+    # Gap between each admission and the latest discharge seen so far for that key
+    prev_discharge = df["Discharge Date"].groupby(key).cummax().shift(1)
+    day_gap = (df["Admit Date"] - prev_discharge).dt.days
 
-    # Split into CA and non-CA
-    ca_df = df[df["Patient State"] == "CA"]
-    non_ca_df = df[df["Patient State"] != "CA"]
+    # A new group starts on a new key or when the gap reaches the threshold;
+    # group numbers are unique across the whole frame
+    new_group = (day_gap >= days_threshold) | (key != key.shift(1))
+    df["Group"] = new_group.cumsum()
+    return df
 
-    ca_inpatients = ca_df[ca_df["Patient Type"] == "Inpatient"]
-    ca_non_inpatients = ca_df[ca_df["Patient Type"] != "Inpatient"]
+def convert_df_to_csv(df):
+    # Render to one string and encode it once rather than growing a BytesIO buffer
+    return df.to_csv(index=False).encode("utf-8")
 
-    grouped_inpatients = ca_inpatients.groupby("Medical Record #", group_keys=False).apply(
-        lambda df: group_patient_records(df, days_threshold)
-    )
-    grouped_inpatients["Group Type"] = "CA Grouped (Inpatient)"
+def figure_to_png(fig):
+    buffer = BytesIO()
+    fig.savefig(buffer, format="png", dpi=100, bbox_inches="tight")
+    plt.close(fig)
+    return buffer.getvalue()
+
+# Charts are cached as PNG bytes so reruns with the same counts skip figure layout
+@st.cache_data
+def render_bar_chart(labels, counts):
+    fig, ax = plt.subplots(figsize=(10, 4))
+    ax.bar(labels, counts)
+    ax.set_title("Unique Patients per Day (Last 30 Days)")
+    ax.set_xlabel("Date")
+    ax.set_ylabel("Unique Patients")
+    fig.autofmt_xdate()  # Rotate date labels for better readability
+    return figure_to_png(fig)
+
+@st.cache_data
+def render_line_chart(dates, counts):
+    fig, ax = plt.subplots()
+    ax.plot(dates, counts, marker='o')
+    ax.set_title("Unique Patients per Day (Last 30 Days)")
+    ax.set_xlabel("Date")
+    ax.set_ylabel("Unique Patients")
+    fig.autofmt_xdate()
+    return figure_to_png(fig)
 
-    ca_non_inpatients = ca_non_inpatients.copy()
-    ca_non_inpatients["Group"] = range(1, len(ca_non_inpatients) + 1)
-    ca_non_inpatients["Group Type"] = "CA Single Record (Non-Inpatient)"
+def merge_patient_stays(df):
+    # Merge each patient's overlapping stays so no patient is counted twice on a day;
+    # patients are compared by their integer category codes rather than MRN strings
+    # Stays with no discharge date, or discharged before admission, cover no day;
+    # left in, an inverted stay would count -1 between its two dates
+    stays = df[df["Group Discharge Date"] >= df["Admit Date"]]
+    codes = stays["Medical Record #"].cat.codes.values
+    order = np.lexsort((stays["Admit Date"].values, codes))
+    codes = pd.Series(codes[order])
+    admit = pd.Series(stays["Admit Date"].values[order])
+    discharge = pd.Series(stays["Group Discharge Date"].values[order])
 
-    grouped_ca = pd.concat([grouped_inpatients, ca_non_inpatients], ignore_index=True)
+    prev_discharge = discharge.groupby(codes).cummax().shift(1)
+    new_stay = (admit > prev_discharge) | (codes != codes.shift(1))
+    stay_ids = new_stay.cumsum()
+    starts = admit.groupby(stay_ids).min().values
+    ends = discharge.groupby(stay_ids).max().values
+    return np.sort(starts), np.sort(ends)
 
-    grouped_non_ca = non_ca_df.groupby("Medical Record #", group_keys=False).apply(
-        lambda df: group_patient_records(df, days_threshold)
+def count_patients_per_day(stays, days):
+    # Patients present on a day: stays started on or before it minus stays ended before it
+    starts, ends = stays
+    day_values = days.values
+    return (
+        np.searchsorted(starts, day_values, side="right")
+        - np.searchsorted(ends, day_values, side="left")
     )
-    grouped_non_ca["Group Type"] = "Non-CA Grouped"
 
-    combined_df = pd.concat([grouped_ca, grouped_non_ca], ignore_index=True)
-    combined_df["Group Discharge Date"] = (
-        combined_df.groupby(["Medical Record #", "Group"])["Discharge Date"]
-        .transform("max")
+def records_on_date(df, day):
+    # df is sorted by Admit Date, so the records admitted by the day form a prefix
+    admitted = np.searchsorted(df["Admit Date"].values, day.to_datetime64(), side="right")
+    candidates = df.iloc[:admitted]
+    return candidates[candidates["Group Discharge Date"] >= day]
+
+@st.cache_data
+def build_grouped(df, days_threshold):
+    # Filter out telemedicine patients
+    df = df[df["Patient Type"] != "Telemedicine"].copy()
+
+    # Correct patient states
+    df["Patient State"] = correct_patient_state(df)
+
+    is_ca = (df["Patient State"] == "CA").values
+    is_single = is_ca & (df["Patient Type"] != "Inpatient").values
+    df["Group Type"] = np.select(
+        [is_single, is_ca],
+        ["CA Single Record (Non-Inpatient)", "CA Grouped (Inpatient)"],
+        default="Non-CA Grouped"
     )
 
-    grouped_only = (
-        combined_df[combined_df["Group"].notna()]
+    # CA inpatient and non-CA records are grouped per patient separately;
+    # each CA non-inpatient record gets a key of its own and stays a single record
+    mrn_codes = df["Medical Record #"].cat.codes.values.astype(np.int64)
+    single_offset = 2 * len(df["Medical Record #"].cat.categories)
+    key = np.where(is_single, single_offset + np.arange(len(df)), 2 * mrn_codes + is_ca)
+
+    df = group_patient_records(df, days_threshold, key)
+    group_discharge = df.groupby("Group")["Discharge Date"].max()
+
+    # Keep each group's earliest record; records without a Medical Record # are dropped
+    df_result = (
+        df.dropna(subset=["Medical Record #"])
         .sort_values(["Medical Record #", "Group", "Admit Date"])
-        .groupby(["Medical Record #", "Group"], as_index=False)
-        .first()
+        .drop_duplicates(subset=["Medical Record #", "Group"], keep="first")
+        .sort_values("Admit Date", kind="stable")
+        .reset_index(drop=True)
     )
-    not_grouped = combined_df[combined_df["Group"].isna()]
-    df_result = pd.concat([grouped_only, not_grouped], ignore_index=True)
+    # Only the kept rows need the group's latest discharge, so map the reduction onto them
+    df_result["Group Discharge Date"] = df_result["Group"].map(group_discharge)
+    return df_result, merge_patient_stays(df_result)
+
+if uploaded_file:
+    df = load_data(uploaded_file)
+
+    # Remove threshold UI and use fixed 20 days
+    days_threshold = 20
+
+    df_result, patient_stays = build_grouped(df, days_threshold)
 
     # ----------- FILTER BY SINGLE DATE -----------
     st.subheader("📅 Choose Date of Interest")
@@ -121,30 +310,18 @@ if uploaded_file:
     if chosen_date:
         chosen_date = pd.to_datetime(chosen_date)
 
-        filtered_df = df_result[
-            (df_result["Admit Date"] <= chosen_date) &
-            (df_result["Group Discharge Date"] >= chosen_date)
-        ]
+        filtered_df = records_on_date(df_result, chosen_date)
 
         # Deduplicate by Medical Record #
-        filtered_df = filtered_df.sort_values("Admit Date")
         filtered_df = filtered_df.drop_duplicates(subset=["Medical Record #"], keep="first")
 
-        columns_to_keep = [
-            "Medical Record #",
-            "First Name",
-            "Last Name",
-            "Med Service",
-            "Patient Address",
-            "Patient Address (ln2)",
-            "Patient City",
-            "Patient State",
-            "Patient Email Address"
-        ]
-        filtered_df = filtered_df[columns_to_keep]
+        filtered_df = filtered_df[OUTPUT_COLUMNS]
 
         st.subheader("🔎 Filtered Patients")
-        st.dataframe(filtered_df)
+        st.write(f"{len(filtered_df):,} patients")
+        st.dataframe(filtered_df.head(PREVIEW_ROWS))
+        if len(filtered_df) > PREVIEW_ROWS:
+            st.caption(f"Showing the first {PREVIEW_ROWS} rows; download the CSV for the full list.")
 
         csv_data = convert_df_to_csv(filtered_df)
         st.download_button(
@@ -158,33 +335,12 @@ if uploaded_file:
         st.subheader("📊 LA Patient Analytics (Past 30 Days)")
 
         date_range = pd.date_range(chosen_date - pd.Timedelta(days=29), chosen_date)
-        daily_patient_counts = []
-        
-        for day in date_range:
-            # Count unique patients present on this day
-            count = df_result[
-                (df_result["Admit Date"] <= day) &
-                (df_result["Group Discharge Date"] >= day)
-            ]["Medical Record #"].nunique()
-            daily_patient_counts.append(count)
+        daily_patient_counts = count_patients_per_day(patient_stays, date_range)
         
+        counts = tuple(int(c) for c in daily_patient_counts)
+
         # Bar Chart: Each bar is one day
-        fig1, ax1 = plt.subplots(figsize=(10, 4))
-        ax1.bar(
-            [d.strftime("%b %d") for d in date_range],
-            daily_patient_counts
-        )
-        ax1.set_title("Unique Patients per Day (Last 30 Days)")
-        ax1.set_xlabel("Date")
-        ax1.set_ylabel("Unique Patients")
-        fig1.autofmt_xdate()  # Rotate date labels for better readability
-        st.pyplot(fig1)
-        
+        st.image(render_bar_chart(tuple(d.strftime("%b %d") for d in date_range), counts))
+
         # Line Chart: Unique patients per day
-        fig2, ax2 = plt.subplots()
-        ax2.plot(date_range, daily_patient_counts, marker='o')
-        ax2.set_title("Unique Patients per Day (Last 30 Days)")
-        ax2.set_xlabel("Date")
-        ax2.set_ylabel("Unique Patients")
-        fig2.autofmt_xdate()
-        st.pyplot(fig2)
+        st.image(render_line_chart(tuple(date_range), counts))